@@ -1,16 +1,28 @@
 import dash
 from dash.dependencies import Output, Input, State
-from dash import dcc, html, dash_table
+from dash import ctx, dcc, html, dash_table
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 import pandas as pd
 import dash_cytoscape as cyto
+from fnmatch import fnmatch
 from glob import glob
+from functools import lru_cache
+import hashlib
 import json
 import csv
 
-from os.path import getmtime
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from os import scandir
+from os import stat
 from os.path import basename
+from os.path import join
+from os.path import split
 
 # production
 inputFolder = "/mnt/volume_annif_projects/data-sets/bldg-regs/docs/validate/nn-bv-stw-ensemble-en/*.json"
@@ -29,6 +41,15 @@ eprintMetrics = eprintFolder + "*.tsv"
 
 seconds = 5  # change to 60 for a minute
 
+# notes columns filtered by the dropdowns, in dropdown order
+filterColumns = ("ml model", "sources", "vocab", "training", "analyzer")
+
+# notes columns drawn as nodes on the network graph
+networkColumns = ("ml model", "sources", "analyzer", "vocab", "training")
+
+# eprint fields left out of the abstracts table
+eprintDropped = frozenset(['corp_creators', 'subjects', "creators", "contributors", "related_url", "documents", "files", "projects", "editors"])
+
 cyto.load_extra_layouts()
 
 cyto_stylesheet = [
@@ -97,20 +118,18 @@ styles = {
 
 def parse_abstract():
 
-    template = []
-    with open(eprintJSON, "r") as f:
-        data = json.load(f)
-        for row in data:
-            template.append(row)
+    # leave the unused nested fields out of the frame
+    template = [
+        {k: v for k, v in row.items() if k not in eprintDropped}
+        for row in loadjson(eprintJSON)
+    ]
     df_eprint = pd.DataFrame(template)
-    df_eprint = df_eprint.drop(['corp_creators', 'subjects', "creators", "contributors", "related_url", "documents", "files", "projects", "editors"], axis=1)
 
-    for index, row in df_eprint.iterrows():
-        text = str(df_eprint.loc[index, 'abstract']) #string
-        if text:
-            text_file = open(eprintFolder + "public-eprint-" + str(df_eprint.loc[index, 'eprintid']) + "-abstract.txt", "w", encoding='utf-8')
-            text_file.write(text)
-            text_file.close()
+    # missing abstracts are NaN, skip them
+    for eprintid, text in zip(df_eprint['eprintid'], df_eprint['abstract']):
+        if isinstance(text, str) and text:
+            with open(f"{eprintFolder}public-eprint-{eprintid}-abstract.txt", "w", encoding='utf-8') as text_file:
+                text_file.write(text)
 
     return df_eprint
 
@@ -124,17 +143,29 @@ def conv(s):
 def parse_metrics():
     jsonData = getjson(eprintMetrics)
 
-    # read json files
-    template = []
+    # read tsv files into columns
+    template = {
+        'uri': [],
+        'keyword': [],
+        'notation': [],
+        'score': [],
+    }
     for file in jsonData:
         with open(file, "r") as f:
             data = csv.reader(f, delimiter="\t", quotechar='"')
             for row in data:
-                row = [conv(s) for s in row]
-                k = {'uri': row[0], 'keyword': row[1] if len(row) >= 2 else 'N/A', 'notation': row[2] if ((len(row) >= 3) & (type(row[2]) != float)) else 'N/A', 'score': row[2] if (type(row[2]) == float) else (row[3] if len(row) >= 3 else 'N/A')}
-                template.append(k)
-
-    return pd.DataFrame(template, columns=['uri', 'keyword', 'notation', 'score'])
+                # annif writes uri, label, [notation,] score
+                third = conv(row[2])
+                template['uri'].append(row[0])
+                template['keyword'].append(row[1])
+                if type(third) == float:
+                    template['notation'].append('N/A')
+                    template['score'].append(third)
+                else:
+                    template['notation'].append(third)
+                    template['score'].append(conv(row[3]))
+
+    return pd.DataFrame(template)
 
 def updateEPrintAbstracts():
   df_abstract = parse_abstract()
@@ -155,24 +186,70 @@ def updateEPrintMetrics():
   )
   return tbl
 
-def cleanTitles():
+def cleanTitles(jsonData):
     # remove unnececary data from path
-    jsonData = getjson(inputFolder)
-    jsonData = [basename(x) for x in jsonData]
-    jsonData = [x[0:-5] for x in jsonData]
+    jsonData = [basename(x)[0:-5] for x in jsonData]
     return jsonData
 
 
+def loadjson(file):
+    with open(file, "rb") as f:
+        raw = f.read()
+    # orjson rejects the NaN/Infinity json.dump writes, retry with json
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+
+@lru_cache(maxsize=256)
+def _cachedjson(file, mtime, size):
+    return loadjson(file)
+
+
+def scanjson(inputFolder):
+    # matching files with their stat result, sorted by modification date
+    folder, pattern = split(inputFolder)
+    files = []
+    # wildcards in the folder itself need glob, scandir lists one folder
+    if any(c in folder for c in "*?["):
+        for path in glob(inputFolder):
+            try:
+                files.append((path, stat(path)))
+            except FileNotFoundError:
+                pass
+    else:
+        try:
+            entries = [
+                e for e in scandir(folder or ".")
+                if not e.name.startswith(".") and fnmatch(e.name, pattern) and e.is_file()
+            ]
+        except FileNotFoundError:
+            return []
+        for e in entries:
+            # files removed since the folder was listed are left out
+            try:
+                files.append((join(folder, e.name), e.stat()))
+            except FileNotFoundError:
+                pass
+    files.sort(key=lambda f: f[1].st_mtime)
+    return files
+
+
 def getjson(inputFolder):
     # get json files and sort by creation date
-    jsonData = []
-    jsonData = glob(inputFolder)
-    jsonData.sort(key=getmtime)
-    return jsonData
+    return [path for path, st in scanjson(inputFolder)]
+
+
+def metricsListing():
+    # path, mtime and size of each metric file, the cache key
+    return tuple((path, st.st_mtime_ns, st.st_size) for path, st in scanjson(inputFolder))
 
 
-def parsejson():
-    # get ml data from jsonfiles
+@lru_cache(maxsize=1)
+def _cachedframe(listing):
 
     template = {
         "Index": [],
@@ -181,21 +258,18 @@ def parsejson():
         "F1_score_doc_avg": [],
     }
 
-    jsonData = getjson(inputFolder)
-
     # read json files
-    for index, file in enumerate(jsonData):
-        with open(file, "r") as f:
-            data = json.load(f)
-            data["Index"] = index
-            for k in template.keys():
-                template[k].append(data[k])
+    for index, (file, mtime, size) in enumerate(listing):
+        data = _cachedjson(file, mtime, size)
+        for k in template.keys():
+            template[k].append(index if k == "Index" else data[k])
 
-    template["Title"] = cleanTitles()
+    # titles from the same listing as the data
+    template["Title"] = cleanTitles([file for file, mtime, size in listing])
     df = pd.DataFrame(template)
     return df
 
-def parseNotes():
+def readNotes(file):
 
     template = {
         "titles": [],
@@ -211,25 +285,82 @@ def parseNotes():
         "comments": [],
     }
 
-    with open(notesFile, "r") as f:
-        data = f.readlines()
+    with open(file, "r") as f:
+        data = f.read().split("\n")
 
-    data = [x.replace("\n", "") for x in data]
-    titles = [x.replace("## ", "") for x in data if "##" in x]
-    text = [data[data.index(x) + 1 : data.index(x) + 1 + 10] for x in data if "##" in x]
+    # note lines follow each heading
+    headings = [(i, x) for i, x in enumerate(data) if "##" in x]
+    titles = [x.replace("## ", "") for i, x in headings]
+    text = [data[i + 1 : i + 1 + 10] for i, x in headings]
 
     for note in text:
         for j in note:
-            j = j.split("=")
-            j = [x.strip() for x in j]
+            # split on the first "=" only, values may contain it too
+            key, _, value = j.partition("=")
+            value = value.strip()
 
-            template[j[0].lower()].append(j[1] if j[1] else "N/A")
+            template[key.strip().lower()].append(value if value else "N/A")
 
     template["titles"] = titles
 
     df = pd.DataFrame(template)
     return df
 
+
+@lru_cache(maxsize=1)
+def _cachednotes(file, mtime, size):
+    # the dropdown options only depend on the notes, not on the selection
+    notes = readNotes(file)
+    return notes, dropdownOptions(notes)
+
+
+def notesKey():
+    st = stat(notesFile)
+    return (notesFile, st.st_mtime_ns, st.st_size)
+
+def dropdownOptions(notes):
+    # options for each dropdown, in dropdown order
+    return [notes[column].unique() for column in filterColumns]
+
+
+def filterNotes(df, notes, ddValues):
+    # notes matching every dropdown selection and their metrics
+    mask = None
+
+    # one isin mask per dropdown with a selection, None and [] are skipped
+    for column, value in zip(filterColumns, ddValues):
+        if value:
+            match = notes[column].isin(value)
+            mask = match if mask is None else mask & match
+
+    if mask is not None:
+        notes = notes[mask]
+        df = df[df["Title"].isin(notes["titles"])]
+
+    return df, notes
+
+
+def selectionKey(ddValues):
+    # hashable form of the dropdown values, None and [] both become ()
+    return tuple(tuple(v) if v else () for v in ddValues)
+
+
+def dataVersion(listing, notesStat):
+    # short fingerprint of the files the graphs are drawn from
+    return hashlib.sha1(repr((listing, notesStat)).encode()).hexdigest()
+
+
+def loadSelection(ddValues, listing, notesStat):
+    # metrics, notes and dropdown options for a dropdown selection
+    return _cachedselection(listing, notesStat, selectionKey(ddValues))
+
+
+@lru_cache(maxsize=32)
+def _cachedselection(listing, notesStat, selection):
+    notes, options = _cachednotes(*notesStat)
+    df, filtered = filterNotes(_cachedframe(listing), notes, selection)
+    return df, filtered, options
+
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.layout = html.Div(
     [
@@ -323,6 +454,7 @@ app.layout = html.Div(
                         dcc.Graph(id="ml", animate=False),  # ml graph
                         html.Div(id="table"),  # notes table
                         dcc.Interval(id="update-line", interval=seconds * 1000),
+                        dcc.Store(id="line-version"),  # data version last drawn
                     ],
                 ),
                 dcc.Tab(
@@ -463,84 +595,66 @@ def updateNetwork(
     ddv_training,
     ddv_analyzer
 ):
-    df = parsejson()
-    notes = parseNotes()
-    metrics = ["ml model", "sources", "analyzer", "vocab", "training"]
-    query = []
-
-    # dropdowns
-    ddModels = notes["ml model"].unique()
-    ddSources = notes["sources"].unique()
-    ddVocab = notes["vocab"].unique()
-    ddTraining = notes["training"].unique()
-    ddAnalyzer = notes["analyzer"].unique()
-    
-    # not is used outside the brackets to prevent a bug.
-    if not (ddv_models == None or ddv_models == []):
-        query.append(f"`ml model` == {ddv_models}")
-
-    if not (ddv_sources == None or ddv_sources == []):
-        query.append(f"sources == {ddv_sources}")
-
-    if not (ddv_vocab == None or ddv_vocab == []):
-        query.append(f"vocab == {ddv_vocab}")
-
-    if not (ddv_training == None or ddv_training == []):
-        query.append(f"training == {ddv_training}")
-
-    if not (ddv_analyzer == None or ddv_analyzer == []):
-        query.append(f"analyzer == {ddv_analyzer}")
-
-    if query != []:
-        query = " and ".join(query)
-        notes = notes.query(query)
-        df = df.query(f'Title == {notes["titles"].values.tolist()}')
-    else:
-        notes = notes
-
-    elements = (
-        [
-            # Nodes elements
-            {
-                "data": {
-                    "id": f"{row[m]}",
-                    "label": f"{row[m]}",
-                    "size": 0,   
-                }
-            }
-            for m in metrics
-            for index, row in notes.iterrows() if row[m] != "N/A"
-        ]
-        + [            {
-                "data": {
-                    "id": f"F1-{row['titles']}",
-                    "label": row["titles"],
-                    "size": df.loc[df["Title"] == row['titles']]['F1_score_doc_avg'].values[0] if len(df.loc[df["Title"] == row['titles']]) != 0 else 0,
-                },
-                "classes": 'red'
+    # filtered data and dropdowns
+    ddValues = (ddv_models, ddv_sources, ddv_vocab, ddv_training, ddv_analyzer)
+    df, notes, ddOptions = loadSelection(ddValues, metricsListing(), notesKey())
+
+    # F1 score per title
+    f1Scores = dict(zip(df["Title"], df["F1_score_doc_avg"]))
+
+    # note rows
+    rows = notes.to_dict("records")
+
+    # F1 node id per note, shared by the F1 node and all of its edges
+    f1Ids = [f"F1-{row['titles']}" for row in rows]
+
+    # Edge elements, each node id is kept once in first seen order
+    nodeIds = {}
+    edges = []
+    for m in networkColumns:
+        for row, f1Id in zip(rows, f1Ids):
+            if row[m] != "N/A":
+                nodeId = row[m]
+                nodeIds[nodeId] = None
+                edges.append(
+                    {
+                        "data": {
+                            "source": nodeId,
+                            "target": f1Id,
+                        },
+                        "classes": m
+                    }
+                )
+
+    # Nodes elements
+    elements = [
+        {
+            "data": {
+                "id": nodeId,
+                "label": nodeId,
+                "size": 0,
             }
-            for index, row in notes.iterrows()
-        ]
-        + [
-            {
-                "data": {
-                    "source": f"{row[m]}",
-                    "target": f"F1-{row['titles']}",
-                },
-                "classes": m
-            }
-            for m in metrics
-            for index, row in notes.iterrows() if row[m] != "N/A"
-        ]
+        }
+        for nodeId in nodeIds
+    ]
+
+    # F1 elements
+    elements.extend(
+        {
+            "data": {
+                "id": f1Id,
+                "label": row["titles"],
+                "size": f1Scores.get(row['titles'], 0),
+            },
+            "classes": 'red'
+        }
+        for row, f1Id in zip(rows, f1Ids)
     )
+    elements.extend(edges)
 
     return (
         elements,
-        ddModels,
-        ddSources,
-        ddVocab,
-        ddTraining,
-        ddAnalyzer
+        *ddOptions,
     )
 
 @app.callback(
@@ -552,7 +666,8 @@ def updateNetwork(
         Output("dropdown_vocab", "options"),
         Output("dropdown_training", "options"),
         Output("dropdown_analyzer", "options"),
-        Output("graphError", "children")
+        Output("graphError", "children"),
+        Output("line-version", "data")
     ],
     [
         Input("update-line", "n_intervals"),
@@ -562,6 +677,7 @@ def updateNetwork(
         Input("dropdown_training", "value"),
         Input("dropdown_analyzer", "value"),
     ],
+    State("line-version", "data"),
 )
 def updateLine(
     n_intervals,
@@ -570,42 +686,20 @@ def updateLine(
     ddv_vocab,
     ddv_training,
     ddv_analyzer,
+    lineVersion,
 ):
 
-    df = parsejson()
-
-    notes = parseNotes()
-    query = []
+    listing = metricsListing()
+    notesStat = notesKey()
 
-    # dropdowns
-    ddModels = notes["ml model"].unique()
-    ddSources = notes["sources"].unique()
-    ddVocab = notes["vocab"].unique()
-    ddTraining = notes["training"].unique()
-    ddAnalyzer = notes["analyzer"].unique()
+    # a tick on its own only redraws once one of the files has changed
+    version = dataVersion(listing, notesStat)
+    if list(ctx.triggered_prop_ids) == ["update-line.n_intervals"] and version == lineVersion:
+        raise PreventUpdate
 
-    # not is used outside the brackets to prevent a bug.
-    if not (ddv_models == None or ddv_models == []):
-        query.append(f"`ml model` == {ddv_models}")
-
-    if not (ddv_sources == None or ddv_sources == []):
-        query.append(f"sources == {ddv_sources}")
-
-    if not (ddv_vocab == None or ddv_vocab == []):
-        query.append(f"vocab == {ddv_vocab}")
-
-    if not (ddv_training == None or ddv_training == []):
-        query.append(f"training == {ddv_training}")
-
-    if not (ddv_analyzer == None or ddv_analyzer == []):
-        query.append(f"analyzer == {ddv_analyzer}")
-
-    if query != []:
-        query = " and ".join(query)
-        notes = notes.query(query)
-        df = df.query(f'Title == {notes["titles"].values.tolist()}')
-    else:
-        notes = notes
+    # filtered data and dropdowns
+    ddValues = (ddv_models, ddv_sources, ddv_vocab, ddv_training, ddv_analyzer)
+    df, notes, ddOptions = loadSelection(ddValues, listing, notesStat)
 
     # graph
     fig = go.Figure()
@@ -664,12 +758,9 @@ def updateLine(
     return (
         fig,
         tbl,
-        ddModels,
-        ddSources,
-        ddVocab,
-        ddTraining,
-        ddAnalyzer,
+        *ddOptions,
         errorMSG,
+        version,
     )
 
 server = app.server